@@ -1,14 +1,18 @@
 import streamlit as st
+import streamlit.components.v1 as components
 import zipfile
-import json
-import io
+import orjson
+import numpy as np
 import pandas as pd
 import folium
-from streamlit_folium import st_folium
-import base64
+import pydeck as pdk
 import os
+import re
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
 
-from folium.plugins import MarkerCluster
+from folium.plugins import FastMarkerCluster
 
 CLASS_MAP = {
     0: "Longitudinal Crack (D00)",
@@ -17,6 +21,43 @@ CLASS_MAP = {
     3: "Pothole (D40)"
 }
 
+# Leaflet callbacks for FastMarkerCluster; each row is [lat, lon, popup_html, ...]
+# Detection rows also carry an image URL (or null) that is only put in the popup once it opens
+DETECTION_MARKER_JS = """
+(function (row) {
+    var icon = L.AwesomeMarkers.icon({icon: "exclamation-triangle", prefix: "fa", markerColor: "red"});
+    var marker = L.marker(new L.LatLng(row[0], row[1]), {icon: icon});
+    marker.bindPopup("", {maxWidth: 600});
+    marker.on("popupopen", function (e) {
+        var image = row[3] ? '<img src="' + row[3] + '" width="600">' : "<i>(Image missing)</i>";
+        e.popup.setContent(row[2] + image);
+    });
+    return marker;
+})
+"""
+
+ROUGHNESS_MARKER_JS = """
+(function (row) {
+    var icon = L.AwesomeMarkers.icon({icon: "car", prefix: "fa", markerColor: "orange"});
+    var marker = L.marker(new L.LatLng(row[0], row[1]), {icon: icon});
+    marker.bindPopup(row[2], {maxWidth: 600});
+    return marker;
+})
+"""
+
+# Survey images are extracted under static/ next to this script, which Streamlit serves at /app/static
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+IMAGES_DIR = os.path.join(APP_DIR, "static", "images")
+IMAGES_URL = "/app/static/images"
+# Records which archive version filled each image folder; kept outside the served static/ tree
+VERSIONS_DIR = os.path.join(APP_DIR, ".image_versions")
+
+# Most points drawn as Folium/Leaflet markers; larger selections switch to a WebGL (pydeck) layer
+FOLIUM_MAX_POINTS = 5000
+
+# Trailing frame number of an image, e.g. "frame_0085.jpg" -> 85
+FRAME_RE = re.compile(r"(\d+)(?=\.jpg$)")
+
 # ---------------------------
 # CONFIG
 # ---------------------------
@@ -32,10 +73,10 @@ if not uploaded_zips:
     assets_folder = "assets/"
     try:
         uploaded_zips = []
-        for fname in os.listdir(assets_folder):
+        for fname in sorted(os.listdir(assets_folder)):
             if fname.endswith(".zip"):
-                with open(os.path.join(assets_folder, fname), "rb") as f:
-                    uploaded_zips.append(io.BytesIO(f.read()))
+                path = os.path.join(assets_folder, fname)
+                uploaded_zips.append((path, os.path.getmtime(path)))
     except Exception as e:
         st.error(f"No uploads and no assets found. {e}")
         st.stop()
@@ -43,59 +84,142 @@ if not uploaded_zips:
 # ---------------------------
 # Load all surveys
 # ---------------------------
-all_detections = []
-all_roughness = []
-
-if "images_cache" not in st.session_state:
-    st.session_state["images_cache"] = {}
-
-for idx, uploaded in enumerate(uploaded_zips):
-    survey_name = getattr(uploaded, 'name', f"Survey_{idx+1}")
-    if survey_name.endswith(".zip"):
-        survey_name = survey_name[:-4]
-
-    try:
-        with zipfile.ZipFile(uploaded) as z:
-            print(f"✅ Processing {survey_name}: {z.namelist()}")
+def process_zip(survey_name, path, mtime):
+    """Read one survey ZIP, returning its detections and roughness frames, frame -> image URL index and image folder."""
+    images_by_frame = {}
+
+    # Open by path so zipfile seeks the file directly instead of reading a full copy into memory
+    with zipfile.ZipFile(path, "r") as z:
+        # One pass over the central directory, keeping each entry's frame number for images
+        metadata_info = None
+        image_infos = []
+        for info in z.infolist():
+            name = info.filename
+            if name.startswith("__MACOSX/"):
+                continue  # macOS resource forks, not real files
+            if name == "metadata.json":
+                metadata_info = info
+                continue
+            match = FRAME_RE.search(name.lower())
+            if match:
+                image_infos.append((info, int(match.group(1))))
+
+        if metadata_info is None:
+            metadata_info = z.getinfo("metadata.json")  # raises zipfile's own KeyError
+        metadata = orjson.loads(z.read(metadata_info))
+
+        # Tag rows with their survey as one column broadcast rather than per-dict inserts
+        detections = pd.DataFrame(metadata.get("detections", [])).assign(survey=survey_name)
+        roughness = pd.DataFrame(metadata.get("roughness", [])).assign(survey=survey_name)
+
+        # Extract images for static serving, indexed by the frame number at the end of the filename.
+        # The folder is named after the archive itself (Survey_N is only a display label), and a
+        # marker file records which archive version filled it so a replaced archive is re-extracted.
+        image_key = os.path.splitext(os.path.basename(path))[0]
+        survey_dir = os.path.join(IMAGES_DIR, image_key)
+        marker_path = os.path.join(VERSIONS_DIR, f"{image_key}.source")
+        source = f"{os.path.abspath(path)}\n{mtime}\n{os.path.getsize(path)}"
+        try:
+            with open(marker_path) as marker:
+                up_to_date = marker.read() == source
+        except OSError:
+            up_to_date = False
+        if not up_to_date:
+            shutil.rmtree(survey_dir, ignore_errors=True)
+        os.makedirs(survey_dir, exist_ok=True)
+
+        image_url = f"{IMAGES_URL}/{quote(image_key)}"
+        for info, frame_num in image_infos:
+            out_path = os.path.join(survey_dir, f"{frame_num}.jpg")
+            if not os.path.exists(out_path):
+                # Stream in chunks so a large JPEG is never held in memory whole
+                with z.open(info) as src_file, open(out_path, "wb") as out:
+                    shutil.copyfileobj(src_file, out, length=1 << 20)
+            images_by_frame[(survey_name, frame_num)] = f"{image_url}/{frame_num}.jpg"
+
+        # Written last, so an interrupted extraction is redone from scratch next time
+        if not up_to_date:
+            os.makedirs(VERSIONS_DIR, exist_ok=True)
+            with open(marker_path, "w") as marker:
+                marker.write(source)
+
+    return detections, roughness, images_by_frame, survey_dir
+
+
+@st.cache_data(show_spinner=False)
+def load_surveys(items):
+    """Parse every survey ZIP once; `items` holds (path, mtime) pairs so edits invalidate the cache."""
+    det_frames = []
+    rough_frames = []
+    images_by_frame = {}
+    image_dirs = []
+
+    jobs = [(f"Survey_{idx+1}", path, mtime) for idx, (path, mtime) in enumerate(items)]
+
+    def run(job):
+        try:
+            return process_zip(*job), None
+        except Exception as e:
+            return None, e
+
+    # Decompression releases the GIL, so archives can be decoded side by side
+    if len(jobs) >= 2:
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+            outcomes = list(ex.map(run, jobs))
+    else:
+        outcomes = [run(job) for job in jobs]
 
-            with z.open("metadata.json") as meta_file:
-                metadata = json.load(meta_file)
+    # st.* calls only work from the script thread, so errors are reported here
+    for (survey_name, _, _), (result, error) in zip(jobs, outcomes):
+        if error is not None:
+            st.error(f"Failed to read {survey_name}: {error}")
+            continue
+        detections, roughness, images, survey_dir = result
+        det_frames.append(detections)
+        rough_frames.append(roughness)
+        images_by_frame.update(images)
+        image_dirs.append(survey_dir)
 
-            detections = metadata.get("detections", [])
-            for d in detections:
-                d["survey"] = survey_name
-            all_detections.extend(detections)
+    det_df = pd.concat(det_frames, ignore_index=True) if det_frames else pd.DataFrame()
+    rough_df = pd.concat(rough_frames, ignore_index=True) if rough_frames else pd.DataFrame()
+    return det_df, rough_df, images_by_frame, image_dirs
 
-            roughness = metadata.get("roughness", [])
-            for r in roughness:
-                r["survey"] = survey_name
-            all_roughness.extend(roughness)
 
-            # Cache images
-            image_files = [f for f in z.namelist() if f.lower().endswith(".jpg")]
-            for image_file in image_files:
-                with z.open(image_file) as img_file:
-                    img_bytes = img_file.read()
-                    st.session_state["images_cache"][(survey_name, image_file)] = img_bytes
+det_df, rough_df, images_by_frame, image_dirs = load_surveys(tuple(uploaded_zips))
 
-    except Exception as e:
-        st.error(f"Failed to read {survey_name}: {e}")
+# The cached index only points at extracted files; if an image folder was removed while the
+# server runs (e.g. `git clean -X`), reload so the images are extracted again
+if not all(os.path.isdir(d) for d in image_dirs):
+    load_surveys.clear()
+    det_df, rough_df, images_by_frame, image_dirs = load_surveys(tuple(uploaded_zips))
 
 # ---------------------------
-# Build DataFrames
+# Clean up DataFrames
 # ---------------------------
-det_df = pd.DataFrame(all_detections)
-if not det_df.empty:
-    det_df["class"] = det_df["class"].map(CLASS_MAP)
-
-rough_df = pd.DataFrame(all_roughness)
-
 # Drop rows without coordinates
 if not det_df.empty:
     det_df = det_df.dropna(subset=["latitude", "longitude"])
 if not rough_df.empty:
     rough_df = rough_df.dropna(subset=["latitude", "longitude"])
 
+# Compact dtypes: categorical surveys make the .isin() filter an integer compare
+if not det_df.empty:
+    det_df = det_df.astype({
+        "survey": "category",
+        "latitude": "float32",
+        "longitude": "float32",
+        "frame": "int32",
+    })
+    # Unknown or missing classes map to NaN rather than failing an integer cast
+    det_df["class"] = det_df["class"].map(CLASS_MAP).astype("category")
+if not rough_df.empty:
+    rough_df = rough_df.astype({
+        "survey": "category",
+        "latitude": "float32",
+        "longitude": "float32",
+        "magnitude_xy": "float32",
+    })
+
 if det_df.empty and rough_df.empty:
     st.warning("No valid detection or roughness data found in any ZIP!")
     st.stop()
@@ -116,16 +240,19 @@ selected_surveys = st.sidebar.multiselect(
 show_detections = st.sidebar.checkbox("Show Detections", value=True)
 show_roughness = st.sidebar.checkbox("Show Roughness", value=True)
 
-# Apply filters
+# Apply filters as a single boolean mask per frame
 if not det_df.empty:
-    det_df = det_df[det_df["survey"].isin(selected_surveys)]
+    if show_detections:
+        det_mask = det_df["survey"].isin(selected_surveys).to_numpy()
+    else:
+        det_mask = np.zeros(len(det_df), dtype=bool)
+    det_df = det_df.loc[det_mask]
 if not rough_df.empty:
-    rough_df = rough_df[rough_df["survey"].isin(selected_surveys)]
-
-if not show_detections:
-    det_df = det_df.iloc[0:0]
-if not show_roughness:
-    rough_df = rough_df.iloc[0:0]
+    if show_roughness:
+        rough_mask = rough_df["survey"].isin(selected_surveys).to_numpy()
+    else:
+        rough_mask = np.zeros(len(rough_df), dtype=bool)
+    rough_df = rough_df.loc[rough_mask]
 
 if det_df.empty and rough_df.empty:
     st.warning("No data for selected surveys after filtering.")
@@ -134,96 +261,155 @@ if det_df.empty and rough_df.empty:
 # ---------------------------
 # Map center
 # ---------------------------
-all_lats = pd.Series(dtype=float)
-all_lons = pd.Series(dtype=float)
-
-if not det_df.empty:
-    all_lats = pd.concat([all_lats, det_df["latitude"]])
-    all_lons = pd.concat([all_lons, det_df["longitude"]])
-if not rough_df.empty:
-    all_lats = pd.concat([all_lats, rough_df["latitude"]])
-    all_lons = pd.concat([all_lons, rough_df["longitude"]])
+frames = [df for df in (det_df, rough_df) if not df.empty]
+all_lats = np.concatenate([df["latitude"].to_numpy(dtype=np.float64) for df in frames]) if frames else np.empty(0)
+all_lons = np.concatenate([df["longitude"].to_numpy(dtype=np.float64) for df in frames]) if frames else np.empty(0)
 
-if all_lats.empty or all_lons.empty:
+if all_lats.size == 0 or all_lons.size == 0:
     st.warning("No valid coordinates found after filtering.")
     st.stop()
 
-center_lat = all_lats.mean()
-center_lon = all_lons.mean()
+center_lat = float(all_lats.mean())
+center_lon = float(all_lons.mean())
 
 # ---------------------------
-# Create Folium Map
+# Popup content
 # ---------------------------
-m = folium.Map(
-    location=[center_lat, center_lon],
-    zoom_start=16,
-    max_zoom=30,  # allow zooming in much further
-    min_zoom=2    # optional: allow zooming far out
-    
-)
+def detection_popups(df, images_by_frame):
+    """Coordinate popup HTML per detection, plus its image URL (None when the frame has no image)."""
+    popups = (
+        "<b>Coordinates:</b> " + df["latitude"].round(5).astype(str)
+        + ", " + df["longitude"].round(5).astype(str) + "<br>"
+    )
+    img_urls = [
+        images_by_frame.get((sv, fr))
+        for sv, fr in zip(df["survey"].to_numpy(), df["frame"].to_numpy(dtype=np.int64).tolist())
+    ]
+    return popups, img_urls
+
+
+def roughness_popups(df):
+    """Coordinate and magnitude popup HTML per roughness reading."""
+    return (
+        "<b>Coordinates:</b> " + df["latitude"].round(5).astype(str)
+        + ", " + df["longitude"].round(5).astype(str) + "<br>"
+        + "<b>Magnitude:</b> " + df["magnitude_xy"].round(2).astype(str)
+    )
 
-# Add Marker Clusters
-detection_cluster = MarkerCluster(name="Detections").add_to(m)
-roughness_cluster = MarkerCluster(name="Roughness").add_to(m)
 
 # ---------------------------
-# Add detections with clustering
+# Create Folium Map
 # ---------------------------
-if not det_df.empty:
-    for _, row in det_df.iterrows():
-        frame_num = row["frame"]
-        survey_name = row["survey"]
+# Each entry is a full rendered document shared by all sessions, so keep only a few
+@st.cache_data(show_spinner=False, max_entries=32)
+def build_map_html(data_key, selected, show_det, show_rough, center, _det_df, _rough_df, _images_by_frame):
+    """Render the filtered map to HTML once per (data, filter) combination.
+
+    `data_key` identifies the loaded archives; the underscored frames are the matching
+    filtered views and are left out of the cache hash.
+    """
+    m = folium.Map(
+        location=list(center),
+        zoom_start=16,
+        max_zoom=30,  # allow zooming in much further
+        min_zoom=2    # optional: allow zooming far out
+    )
+
+    # ---------------------------
+    # Add detections with clustering
+    # ---------------------------
+    if not _det_df.empty:
+        lat = _det_df["latitude"].to_numpy().tolist()
+        lon = _det_df["longitude"].to_numpy().tolist()
+        popups, img_urls = detection_popups(_det_df, _images_by_frame)
+
+        det_data = list(zip(lat, lon, popups.tolist(), img_urls))
+        FastMarkerCluster(det_data, callback=DETECTION_MARKER_JS, name="Detections").add_to(m)
+
+    # ---------------------------
+    # Add roughness with clustering
+    # ---------------------------
+    if not _rough_df.empty:
+        lat = _rough_df["latitude"].to_numpy().tolist()
+        lon = _rough_df["longitude"].to_numpy().tolist()
+        popups = roughness_popups(_rough_df)
+
+        rough_data = list(zip(lat, lon, popups.tolist()))
+        FastMarkerCluster(rough_data, callback=ROUGHNESS_MARKER_JS, name="Roughness").add_to(m)
+
+    # Add layer control only if there's at least one layer
+    if not _det_df.empty or not _rough_df.empty:
+        folium.LayerControl().add_to(m)
+
+    return m.get_root().render()
 
-        popup_html = f"""
-        <b>Coordinates:</b> {row['latitude']:.5f}, {row['longitude']:.5f}<br>
-        """
-
-        img_bytes = None
-        frame_num_str = str(int(frame_num))
-        for (survey, filename), img in st.session_state["images_cache"].items():
-            if survey == survey_name and filename.lower().rstrip(".jpg").endswith(frame_num_str):
-                img_bytes = img
-                break
-
-        if img_bytes:
-            b64 = base64.b64encode(img_bytes).decode("utf-8")
-            img_tag = f'<img src="data:image/jpeg;base64,{b64}" width="600">'
-            popup_html += img_tag
-        else:
-            popup_html += "<i>(Image missing)</i>"
-
-        folium.Marker(
-            location=[row["latitude"], row["longitude"]],
-            popup=folium.Popup(popup_html, max_width=600),
-            icon=folium.Icon(color="red", icon="exclamation-triangle", prefix="fa")
-        ).add_to(detection_cluster)
 
 # ---------------------------
-# Add roughness with clustering
+# Create pydeck map (large surveys)
 # ---------------------------
-if not rough_df.empty:
-    for _, row in rough_df.iterrows():
-        survey_name = row["survey"]
-        popup_html = f"""
-        <b>Coordinates:</b> {row['latitude']:.5f}, {row['longitude']:.5f}<br>
-        <b>Magnitude:</b> {row['magnitude_xy']:.2f}
-        """
+def build_deck(center, det_df, rough_df, images_by_frame):
+    """Draw all points as WebGL scatterplot layers, with the popup HTML shown as a hover tooltip."""
+    layers = []
 
-        folium.Marker(
-            location=[row["latitude"], row["longitude"]],
-            popup=folium.Popup(popup_html, max_width=600),
-            icon=folium.Icon(color="orange", icon="car", prefix="fa")
-        ).add_to(roughness_cluster)
+    if not det_df.empty:
+        popups, img_urls = detection_popups(det_df, images_by_frame)
+        images = '<img src="' + pd.Series(img_urls, index=det_df.index, dtype=object) + '" width="400">'
+        data = pd.DataFrame({
+            "latitude": det_df["latitude"].astype("float64"),
+            "longitude": det_df["longitude"].astype("float64"),
+            "tooltip": popups + images.fillna("<i>(Image missing)</i>"),
+        })
+        layers.append(pdk.Layer(
+            "ScatterplotLayer",
+            data=data,
+            get_position=["longitude", "latitude"],
+            get_fill_color=[255, 0, 0],
+            get_radius=5,
+            radius_min_pixels=3,
+            pickable=True,
+        ))
+
+    if not rough_df.empty:
+        data = pd.DataFrame({
+            "latitude": rough_df["latitude"].astype("float64"),
+            "longitude": rough_df["longitude"].astype("float64"),
+            "tooltip": roughness_popups(rough_df),
+        })
+        layers.append(pdk.Layer(
+            "ScatterplotLayer",
+            data=data,
+            get_position=["longitude", "latitude"],
+            get_fill_color=[255, 165, 0],
+            get_radius=5,
+            radius_min_pixels=3,
+            pickable=True,
+        ))
+
+    return pdk.Deck(
+        layers=layers,
+        initial_view_state=pdk.ViewState(latitude=center[0], longitude=center[1], zoom=16),
+        tooltip={"html": "{tooltip}"},
+    )
 
-# Add layer control only if there's at least one layer
-if not det_df.empty or not rough_df.empty:
-    folium.LayerControl().add_to(m)
 
 # ---------------------------
 # Show map
 # ---------------------------
 st.subheader("Map View")
-st_data = st_folium(m, width=None, height=600, use_container_width=True)
+if len(det_df) + len(rough_df) > FOLIUM_MAX_POINTS:
+    st.pydeck_chart(build_deck((center_lat, center_lon), det_df, rough_df, images_by_frame), height=600)
+else:
+    map_html = build_map_html(
+        tuple(uploaded_zips),
+        tuple(sorted(selected_surveys)),
+        show_detections,
+        show_roughness,
+        (center_lat, center_lon),
+        det_df,
+        rough_df,
+        images_by_frame,
+    )
+    components.html(map_html, height=600)
 
 # ---------------------------
 # Show tables